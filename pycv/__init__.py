@@ -1,4 +1,29 @@
-from .pycv import PyCv
-from .datastore import DataStore, YamlStore
-from .baseclasses import Education, Job, SkillCategory, CarStory, PersonalData, Cvitem, Language, JobDescription, Statement, Letterinfo
-from .ai import Ai, StubAi
+import importlib
+
+# Submodules are only imported on first access, so e.g. `main.py --help`
+# does not pay for pydantic, jinja2 and the AI SDKs.
+_LAZY = {
+    'PyCv': '.pycv',
+    'DataStore': '.datastore',
+    'YamlStore': '.datastore',
+    'Education': '.baseclasses',
+    'Job': '.baseclasses',
+    'SkillCategory': '.baseclasses',
+    'CarStory': '.baseclasses',
+    'PersonalData': '.baseclasses',
+    'Cvitem': '.baseclasses',
+    'Language': '.baseclasses',
+    'JobDescription': '.baseclasses',
+    'Statement': '.baseclasses',
+    'Letterinfo': '.baseclasses',
+    'Ai': '.ai',
+    'StubAi': '.ai',
+    'sanitize_text_for_latex': '.utils',
+}
+
+__all__ = list(_LAZY)
+
+def __getattr__(name):
+    if name not in _LAZY:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(importlib.import_module(_LAZY[name], __name__), name)
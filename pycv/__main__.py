@@ -0,0 +1,31 @@
+import logging
+import click
+
+@click.command()
+@click.option('--joblink', '-j', prompt='Link to the job ad', help='URL of the job advertisement. Can be a link to a local file.')
+@click.option('--projectname', '-n', prompt='Project name', help='Name for the output report')
+@click.option('--compile/--no-compile', '-c/-nc', default=True, help='Compile the LaTeX output (default: True)')
+@click.option('--batch', '-b', is_flag=True, help='Use the (cheaper, but slower) message batch API')
+@click.option('--no-cache', is_flag=True, envvar='PYCV_NO_CACHE', help='Ask the AI again instead of reusing cached answers (or set PYCV_NO_CACHE=1)')
+@click.option('--verbose', '-v', is_flag=True, help='Enable verbose logging')
+@click.option('--datadir', '-d', default='data', help='Directory containing YAML data files (default: data)')
+def main(joblink: str, projectname: str, compile: bool, batch: bool, no_cache: bool, verbose: bool, datadir: str):
+    """Generate a customized CV based on a job posting."""
+    log_level = logging.DEBUG if verbose else logging.INFO
+    logging.basicConfig(
+        level=log_level, 
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    # Imported here, so that --help does not load the whole package
+    from .pycv import PyCv
+
+    # Initialize PyCv with datadir, batch mode and caching
+    cv = PyCv(joblink, projectname, datadir, batch, not no_cache)
+
+    # Generate and save LaTeX, compile if requested
+    if not cv.save_latex(compile):
+        raise click.ClickException("Compiling the LaTeX output failed")
+
+if __name__ == "__main__":
+    main()
@@ -1,131 +1,318 @@
 import os
+import re
 import json
-import yaml
+import shelve
+import string
+import asyncio
+import hashlib
 import logging
-import instructor
-from anthropic import Anthropic
+import functools
+import collections.abc
+from pathlib import Path
+from dataclasses import dataclass
 from dotenv import load_dotenv
-from typing import Iterable
-from pydantic import BaseModel, Field
-from .baseclasses import CarStory, Cvitem, JobDescription, Summary, Letterinfo
+from typing import Iterable, Optional, get_args, get_origin
+from pydantic import BaseModel, TypeAdapter, create_model
+from .baseclasses import Cvitem, JobDescription, Summary, Letterinfo, CombinedCarsResult
 
-load_dotenv()  # Load environment variables from .env file
+@dataclass(frozen=True)
+class AiConfig:
+    api_key: Optional[str]
+    model: str = "claude-3-5-sonnet-20240620"
+    max_tokens: int = 4096
+    temperature: float = 0
+    max_retries: int = 4
+    batch_poll_interval: int = 10
+    cache_file: str = '.pycv-cache'
+
+    @classmethod
+    def from_env(cls) -> 'AiConfig':
+        load_dotenv()  # Load environment variables from .env file
+        return cls(api_key=os.getenv('ANTHROPIC_API_KEY'))
+
+@functools.lru_cache(maxsize=1)
+def _get_config() -> AiConfig:
+    """Resolve the AI settings once per process"""
+    return AiConfig.from_env()
+
+# The job ad field; {{job}} is an escaped brace, not the field
+_JOB_FIELD = re.compile(r'(?<!\{)\{job\}')
+
+def _split_prompt(template: str) -> tuple[str, str]:
+    """Split a template at the start of the line with {job}. The part before it does not
+    depend on the job ad and can be cached; a template without {job} has no such part."""
+    match = _JOB_FIELD.search(template)
+    if match is None:
+        return "", template
+    cut = template.rfind('\n', 0, match.start()) + 1
+    return template[:cut], template[cut:]
+
+def _compile_template(template: str):
+    """Parse the placeholders of a str.format template once and return a function
+    that fills them in. The prompts only use plain {name} fields."""
+    parts = [(literal, name) for literal, name, _, _ in string.Formatter().parse(template)]
+    def render(**fields) -> str:
+        return "".join(literal + (fields[name] if name is not None else "") for literal, name in parts)
+    return render
+
+# Prompt templates are read, split and compiled once at import, so a missing one fails right away
+_PROMPT_DIR = Path(__file__).parent
+_PROMPTS = {
+    name: tuple(map(_compile_template, _split_prompt((_PROMPT_DIR / f"{name}.txt").read_text())))
+    for name in ("cars-combined-prompt", "jobdescription-prompt", "summary-prompt", "letterinfo-prompt")
+}
+
+def _render_prompt(name: str, **fields) -> list:
+    """Fill in a prompt template as content blocks. Everything before the job ad is
+    marked for Anthropic's prompt cache, so reruns against another job ad reuse it."""
+    prefix, suffix = _PROMPTS[name]
+    cached = prefix(**fields)
+    blocks = [{"type": "text", "text": cached, "cache_control": {"type": "ephemeral"}}] if cached else []
+    blocks.append({"type": "text", "text": suffix(**fields)})
+    return blocks
+
+@functools.lru_cache(maxsize=None)
+def _adapter(respmodel) -> TypeAdapter:
+    """Return a TypeAdapter for a response model, mapping Iterable[X] to list[X]"""
+    if get_origin(respmodel) is collections.abc.Iterable:
+        return TypeAdapter(list[get_args(respmodel)[0]])
+    return TypeAdapter(respmodel)
+
+@functools.lru_cache(maxsize=None)
+def _list_model(item: type) -> type[BaseModel]:
+    """Wrap a list of items in a model, so list answers come with their completion"""
+    return create_model(f"{item.__name__}List", items=(list[item], ...))
+
+@functools.lru_cache(maxsize=None)
+def _schema(respmodel) -> str:
+    """Return the JSON schema of a response model; it is built only once per model"""
+    return json.dumps(_adapter(respmodel).json_schema())
+
+def _parse_json(text: str, respmodel):
+    """Validate the JSON part of a plain text answer against a response model"""
+    start = min(i for i in (text.find('{'), text.find('['), len(text)) if i >= 0)
+    end = max(text.rfind('}'), text.rfind(']')) + 1
+    return _adapter(respmodel).validate_json(text[start:end])
 
 class Ai:
-    def __init__(self):
-        self.model = "claude-3-5-sonnet-20240620"
-        self.max_tokens = 4096
-        self.api_key = os.getenv('ANTHROPIC_API_KEY')
-        if not self.api_key:
+    def __init__(self, use_cache: bool = True, config: Optional[AiConfig] = None):
+        self.cfg = config or _get_config()
+        self.use_cache = use_cache
+        if not self.cfg.api_key:
             raise ValueError("ANTHROPIC_API_KEY environment variable is not set")
         self.logger = logging.getLogger(self.__class__.__name__)
+        # The SDKs are slow to import, so only load them once we really talk to the AI
+        import instructor
+        from anthropic import AsyncAnthropic
+        # One client for all requests, so they share its connection pool. The SDK
+        # retries rate limits, overloads and connection errors with backoff and jitter.
+        self.anthropic = AsyncAnthropic(api_key=self.cfg.api_key, max_retries=self.cfg.max_retries)
+        self.client = instructor.from_anthropic(self.anthropic, mode=instructor.Mode.ANTHROPIC_JSON)
+
+    def _cache_key(self, prompt:list, respmodel, max_tokens:Optional[int]) -> str:
+        """Hash everything that influences the answer"""
+        key = json.dumps({
+            "model": self.cfg.model,
+            "max_tokens": max_tokens or self.cfg.max_tokens,
+            "temperature": self.cfg.temperature,
+            "prompt": "".join(block["text"] for block in prompt),
+            "schema": _schema(respmodel),
+        }, sort_keys=True)
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def _from_cache(self, key:str, respmodel):
+        """Return a cached answer, or None if there is none"""
+        if not self.use_cache:
+            return None
+        with shelve.open(self.cfg.cache_file) as cache:
+            cached = cache.get(key)
+        if cached is None:
+            return None
+        self.logger.info("Using cached answer.")
+        return _adapter(respmodel).validate_json(cached)
+
+    def _to_cache(self, key:str, respmodel, res):
+        if self.use_cache:
+            with shelve.open(self.cfg.cache_file) as cache:
+                cache[key] = _adapter(respmodel).dump_json(res).decode()
 
-    def ask(self, prompt:str, respmodel):
-        client = instructor.from_anthropic(Anthropic(), mode=instructor.Mode.ANTHROPIC_JSON)
+    def _log_usage(self, usage):
+        """Log the token usage of an answer, including prompt cache hits"""
+        self.logger.debug(
+                "Tokens: %d in, %d read from and %d written to the prompt cache, %d out",
+                usage.input_tokens,
+                usage.cache_read_input_tokens or 0,
+                usage.cache_creation_input_tokens or 0,
+                usage.output_tokens,
+        )
+
+    async def ask(self, prompt:list, respmodel, max_tokens:Optional[int] = None):
+        key = self._cache_key(prompt, respmodel, max_tokens)
+        cached = self._from_cache(key, respmodel)
+        if cached is not None:
+            return cached
         self.logger.info("Asking AI for help... ")
-        res = client.chat.completions.create(
-                model=self.model,
-                max_tokens=self.max_tokens,
-                response_model=respmodel,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": prompt,
-                    }
-            ],
+        messages = [
+            {
+                "role": "user",
+                "content": prompt,
+            }
+        ]
+        # Lists are wrapped in a model rather than streamed with create_iterable: a stream
+        # ends quietly with the items parsed so far when the answer is cut off at max_tokens.
+        # Here instructor raises instead, so a truncated answer is never used or cached.
+        iterable = get_origin(respmodel) is collections.abc.Iterable
+        res, completion = await self.client.chat.completions.create_with_completion(
+                model=self.cfg.model,
+                max_tokens=max_tokens or self.cfg.max_tokens,
+                temperature=self.cfg.temperature,
+                response_model=_list_model(get_args(respmodel)[0]) if iterable else respmodel,
+                messages=messages,
         )
+        self._log_usage(completion.usage)
+        if iterable:
+            res = res.items
         self.logger.info("... answer received.")
+        self._to_cache(key, respmodel, res)
+        return res
+
+    async def ask_batch(self, prompts: dict[str, tuple[list, type, Optional[int]]]) -> dict:
+        """Send several independent prompts as one Message Batch (half the price, but slower)"""
+        client = self.anthropic
+        res = {}
+        keys = {}
+        requests = []
+        for key, (prompt, respmodel, max_tokens) in prompts.items():
+            keys[key] = self._cache_key(prompt, respmodel, max_tokens)
+            cached = self._from_cache(keys[key], respmodel)
+            if cached is not None:
+                res[key] = cached
+                continue
+            requests.append({
+                "custom_id": key,
+                "params": {
+                    "model": self.cfg.model,
+                    "max_tokens": max_tokens or self.cfg.max_tokens,
+                    "temperature": self.cfg.temperature,
+                    "system": "Answer only with JSON that validates against the following "
+                              "JSON schema. Return an instance, not the schema itself.\n\n" + _schema(respmodel),
+                    "messages": [
+                        {
+                            "role": "user",
+                            "content": prompt,
+                        }
+                    ],
+                },
+            })
+        if not requests:
+            return res
+        self.logger.info("Submitting batch to AI... ")
+        batch = await client.messages.batches.create(requests=requests)
+        while batch.processing_status != "ended":
+            await asyncio.sleep(self.cfg.batch_poll_interval)
+            batch = await client.messages.batches.retrieve(batch.id)
+        async for entry in await client.messages.batches.results(batch.id):
+            if entry.result.type != "succeeded":
+                raise RuntimeError(f"Batch request '{entry.custom_id}' {entry.result.type}")
+            respmodel = prompts[entry.custom_id][1]
+            self._log_usage(entry.result.message.usage)
+            if entry.result.message.stop_reason == "max_tokens":
+                raise RuntimeError(f"Batch request '{entry.custom_id}' was cut off at max_tokens")
+            res[entry.custom_id] = _parse_json(entry.result.message.content[0].text, respmodel)
+            self._to_cache(keys[entry.custom_id], respmodel, res[entry.custom_id])
+        self.logger.info("... batch answers received.")
         return res
-    
+
     def get_json_for(self, arr: list) -> str:
-        res = [item.model_dump() for item in arr]
-        return json.dumps(res)
+        """Serialize a list of models"""
+        return _adapter(list[type(arr[0])]).dump_json(arr).decode() if arr else "[]"
 
-    def get_experience(self, jobs:list, carstories:list, descriptions:list, joblink:str) -> Iterable[Cvitem]:
-        self.logger.info("Getting job experience information...")
-        promptpath = os.path.join(os.path.dirname(__file__), 'cars-prompt.txt')
-        with open(promptpath, 'r') as f:
-            prompt = f.read()
-        prompt = prompt.format(
+    def experience_request(self, jobs:list, carstories:list, joblink:str) -> tuple[list, type, Optional[int]]:
+        prompt = _render_prompt('cars-combined-prompt',
                     jobs=self.get_json_for(jobs),
                     cars=self.get_json_for(carstories),
                     job=joblink
         )
-        selectedStories = self.ask(prompt, Iterable[CarStory])
-        promptpath = os.path.join(os.path.dirname(__file__), 'refine-cars-prompt.txt')
-        with open(promptpath, 'r') as f:
-            prompt = f.read()
-        prompt = prompt.format(
-                    cars=self.get_json_for(selectedStories),
-                    descriptions=self.get_json_for(descriptions),
-                    job=joblink
-        )
-        return self.ask(prompt, Iterable[Cvitem])
+        return prompt, CombinedCarsResult, 4096
 
-    def get_job_summaries(self, jobs:list, carstories:list, statements:list, joblink:str) -> Iterable[JobDescription]:
-        self.logger.info("Getting job summaries...")
-        promptpath = os.path.join(os.path.dirname(__file__), 'jobdescription-prompt.txt')
-        with open(promptpath, 'r') as f:
-            prompt = f.read()
-        prompt = prompt.format(
+    def job_summaries_request(self, jobs:list, carstories:list, statements:list, joblink:str) -> tuple[list, type, Optional[int]]:
+        prompt = _render_prompt('jobdescription-prompt',
                     jobs=self.get_json_for(jobs),
                     cars=self.get_json_for(carstories),
                     statements=self.get_json_for(statements),
                     job=joblink
         )
-        return self.ask(prompt, Iterable[JobDescription])
+        # One description per job, so a fixed small cap would cut off longer CVs: use the default
+        return prompt, Iterable[JobDescription], None
 
-    def get_summary(self, skills:list, carstories:list, statements:list, jobs:list, joblink:str) -> Summary:
-        self.logger.info("Getting resume summary...")
-        promptpath = os.path.join(os.path.dirname(__file__), 'summary-prompt.txt')
-        with open(promptpath, 'r') as f:
-            prompt = f.read()
-        prompt = prompt.format(
+    def summary_request(self, skills:list, carstories:list, statements:list, jobs:list, joblink:str) -> tuple[list, type, Optional[int]]:
+        prompt = _render_prompt('summary-prompt',
                     skills=self.get_json_for(skills),
                     cars=self.get_json_for(carstories),
                     statements=self.get_json_for(statements),
                     jobs=self.get_json_for(jobs),
                     job=joblink
         )
-        return self.ask(prompt, Summary)
+        return prompt, Summary, 1024
 
-    def get_letterinfo(self, statements:list, carstories:list, joblink:str) -> Letterinfo:
-        self.logger.info("Getting coverletter...")
-        promptpath = os.path.join(os.path.dirname(__file__), 'letterinfo-prompt.txt')
-        with open(promptpath, 'r') as f:
-            prompt = f.read()
-        prompt = prompt.format(
+    def letterinfo_request(self, statements:list, carstories:list, joblink:str) -> tuple[list, type, Optional[int]]:
+        prompt = _render_prompt('letterinfo-prompt',
                     job=joblink,
                     statements=self.get_json_for(statements),
                     cars=self.get_json_for(carstories),
         )
-        return self.ask(prompt, Letterinfo)
+        return prompt, Letterinfo, 2048
 
+    async def get_experience(self, jobs:list, carstories:list, joblink:str) -> Iterable[Cvitem]:
+        self.logger.info("Getting job experience information...")
+        res = await self.ask(*self.experience_request(jobs, carstories, joblink))
+        return res.items
 
-class StubAi:
-    def get_experience(self, jobs:list, carstories:list, descriptions:list, joblink:str) -> Iterable[CarStory]:
-        return [
-            Cvitem(job=1, item="foo"),
-            Cvitem(job=1, item="bar"),
-            Cvitem(job=1, item="baz"),
-            Cvitem(job=2, item="foo"),
-            Cvitem(job=2, item="bar"),
-            Cvitem(job=2, item="baz"),
-        ]
+    async def get_job_summaries(self, jobs:list, carstories:list, statements:list, joblink:str) -> Iterable[JobDescription]:
+        self.logger.info("Getting job summaries...")
+        return await self.ask(*self.job_summaries_request(jobs, carstories, statements, joblink))
+
+    async def get_summary(self, skills:list, carstories:list, statements:list, jobs:list, joblink:str) -> Summary:
+        self.logger.info("Getting resume summary...")
+        return await self.ask(*self.summary_request(skills, carstories, statements, jobs, joblink))
+
+    async def get_letterinfo(self, statements:list, carstories:list, joblink:str) -> Letterinfo:
+        self.logger.info("Getting coverletter...")
+        return await self.ask(*self.letterinfo_request(statements, carstories, joblink))
 
-    def get_summary(self, skills:list, statements:list, joblink:str) -> Iterable[JobDescription]:
-        return Summary(summary="This is some example text.")
 
-    def get_job_summaries(self, skills:list, statements:list, joblink:str) -> Iterable[JobDescription]:
+class StubAi(Ai):
+    """Answers every prompt with canned data, so the LaTeX side can be tested offline"""
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    async def ask(self, prompt:list, respmodel, max_tokens:Optional[int] = None):
+        if respmodel is Summary:
+            return Summary(summary="This is some example text.")
+        if respmodel is Letterinfo:
+            return Letterinfo(
+                    recipient=["ABC Company","Somestreet 42 Happytown"],
+                    subject="Application for the position of Head Of Everything",
+                    opening="Friends, romans, countrymen, lend me your ear",
+                    content="I really really want to get this thing",
+            )
+        if respmodel is CombinedCarsResult:
+            return CombinedCarsResult(
+                    reasoning="",
+                    selected=[],
+                    items=[
+                        Cvitem(job=1, item="foo"),
+                        Cvitem(job=1, item="bar"),
+                        Cvitem(job=1, item="baz"),
+                        Cvitem(job=2, item="foo"),
+                        Cvitem(job=2, item="bar"),
+                        Cvitem(job=2, item="baz"),
+                    ],
+            )
         return [
                 JobDescription(job=1, description="Something I've done"),
                 JobDescription(job=2, description="Something else I've done"),
         ]
 
-    def get_letterinfo(self, statements:list, carstories:list, joblink:str) -> Letterinfo:
-        return Letterinfo(
-                recipient=["ABC Company","Somestreet 42 Happytown"],
-                subject="Application for the position of Head Of Everything",
-                opening="Friends, romans, countrymen, lend me your ear",
-                content="I really really want to get this thing",
-        )
+    async def ask_batch(self, prompts: dict[str, tuple[list, type, Optional[int]]]) -> dict:
+        return {key: await self.ask(*request) for key, request in prompts.items()}
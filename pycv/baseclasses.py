@@ -1,5 +1,4 @@
 from pathlib import Path
-from instructor import patch
 from typing import List, Dict, Optional
 from pydantic import BaseModel, Field
 
@@ -69,3 +68,8 @@ class PersonalData(BaseModel):
 
 class Summary(BaseModel):
     summary: str
+
+class CombinedCarsResult(BaseModel):
+    reasoning: str = Field(description="Short reasoning on which CAR stories fit the job ad best")
+    selected: List[CarStory]
+    items: List[Cvitem]
@@ -1,10 +1,18 @@
+import os
 from pathlib import Path
 from typing import List, Dict, Optional
 import yaml
 import json
+from operator import itemgetter
 from abc import ABC, abstractmethod
 from .baseclasses import Education, Job, CarStory, SkillCategory, Language, Statement, Summary, Project
 
+# The libyaml based loader is much faster, but only there if PyYAML was built against libyaml
+try:
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
 class DataStore(ABC):
     @abstractmethod
     def load_data(self):
@@ -27,74 +35,34 @@ class YamlStore(DataStore):
     def load_yaml(self, file_path: str) -> Dict:
         """Load and parse a YAML file"""
         with open(file_path, 'r', encoding='utf-8') as f:
-            return yaml.safe_load(f)
+            return yaml.load(f, Loader=_YamlLoader)
+
+    # Attribute, file, model and sort key of each list of entries
+    _LISTS = (
+        ("education", "education.yaml", Education, "edu"),
+        ("jobs", "jobs.yaml", Job, "job"),
+        ("projects", "projects.yaml", Project, "project"),
+        ("skills", "skills.yaml", SkillCategory, "category"),
+        ("languages", "languages.yaml", Language, "language"),
+        ("carstories", "carstories.yaml", CarStory, "job"),
+        ("statements", "statements.yaml", Statement, "job"),
+    )
+
+    def _load_list(self, file_path: str, model, key: str) -> list:
+        """Load a YAML list of entries into models, sorted by key. The raw entries
+        are sorted, which is cheaper than sorting the validated models."""
+        return [model(**entry) for entry in sorted(self.load_yaml(file_path), key=itemgetter(key))]
 
     def load_data(self):
         """Load all YAML files from the data directory"""
         data_path = Path(self.datadir)
+        # List the directory once instead of checking every file on its own
+        present = {entry.name for entry in os.scandir(data_path) if entry.is_file()} if data_path.is_dir() else set()
 
-        # Load summary
-        if (data_path / "summary.yaml").exists():
-            data = self.load_yaml(str(data_path / "summary.yaml"))
-            self.summary = Summary(summary=data.get('summary', ''))
-
-        # Load education
-        if (data_path / "education.yaml").exists():
-            edu_data = self.load_yaml(str(data_path / "education.yaml"))
-            self.education = sorted(
-                [Education(**entry) for entry in edu_data],
-                key=lambda x: x.edu
-            )
-
-        # Load jobs
-        if (data_path / "jobs.yaml").exists():
-            job_data = self.load_yaml(str(data_path / "jobs.yaml"))
-            self.jobs = sorted(
-                [Job(**entry) for entry in job_data],
-                key=lambda x: x.job
-            )
-        
-        # Load projects
-        if (data_path / "projects.yaml").exists():
-            project_data = self.load_yaml(str(data_path / "projects.yaml"))
-            self.projects = sorted(
-                [Project(**entry) for entry in project_data],
-                key=lambda x: x.project
-            )
-        
-        # Load skills
-        if (data_path / "skills.yaml").exists():
-            skill_data = self.load_yaml(str(data_path / "skills.yaml"))
-            self.skills = sorted(
-                    [SkillCategory(**entry) for entry in skill_data],
-                    key=lambda x: x.category
-            )
-        
-        # Load languages
-        if (data_path / "languages.yaml").exists():
-            lang_data = self.load_yaml(str(data_path / "languages.yaml"))
-            self.languages = sorted(
-                    [Language(**entry) for entry in lang_data],
-                    key=lambda x: x.language
-            )
-
-        # Load carstories
-        if (data_path / "carstories.yaml").exists():
-            cars_data = self.load_yaml(str(data_path / "carstories.yaml"))
-            self.carstories = sorted(
-                [CarStory(**entry) for entry in cars_data],
-                key=lambda x: x.job
-            )
-        
-        # Load personal data
-        if (data_path / "headers.yaml").exists():
+        if "summary.yaml" in present:
+            self.summary = Summary(summary=self.load_yaml(str(data_path / "summary.yaml")).get('summary', ''))
+        if "headers.yaml" in present:
             self.headers = self.load_yaml(str(data_path / "headers.yaml"))[0]
-
-        # Load statements
-        if (data_path / "statements.yaml").exists():
-            statement_data = self.load_yaml(str(data_path / "statements.yaml"))
-            self.statements = sorted(
-                [Statement(**entry) for entry in statement_data],
-                key=lambda x: x.job
-            )
-
+        for attr, filename, model, key in self._LISTS:
+            if filename in present:
+                setattr(self, attr, self._load_list(str(data_path / filename), model, key))
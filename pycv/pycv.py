@@ -1,28 +1,78 @@
 import os
-import json
-import yaml
+import re
+import asyncio
 import logging
+import functools
 import jinja2
-from pathlib import Path
-import instructor
-from anthropic import Anthropic
-from typing import List, Dict, Optional, Iterable
-from pydantic import BaseModel, Field
+from dataclasses import dataclass
+from typing import List, Optional
 from .datastore import YamlStore
-from .baseclasses import CarStory, Cvitem, Language
 from .ai import Ai, StubAi
+from .utils import sanitize_text_for_latex
+
+JINJA_CACHE_DIR = '.jinja_cache'
+
+# Error messages ("! ...") and the line numbers they refer to ("l.42 ...") in a LaTeX log
+_LATEX_ERROR_LINE = re.compile(r'!|l\.\d+ ')
+
+@functools.lru_cache(maxsize=None)
+def _get_jinja_env(template_dir: str) -> jinja2.Environment:
+    """Build the LaTeX flavoured Jinja environment once per process, so its
+    compiled templates are shared by every PyCv"""
+    # Compiled templates are kept on disk, so reruns skip parsing them
+    os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+    env = jinja2.Environment(
+        block_start_string = r'\BLOCK{',
+        block_end_string = '}',
+        variable_start_string = r'\VAR{',
+        variable_end_string = '}',
+        comment_start_string = r'\#{',
+        comment_end_string = '}',
+        line_statement_prefix = '%%',
+        line_comment_prefix = '%#',
+        trim_blocks = True,
+        autoescape = False,
+        cache_size = -1,
+        # The templates do not change while pycv runs, so skip the up-to-date checks
+        auto_reload = False,
+        loader = jinja2.FileSystemLoader(template_dir),
+        bytecode_cache = jinja2.FileSystemBytecodeCache(JINJA_CACHE_DIR),
+    )
+    env.filters['latex_safe'] = sanitize_text_for_latex
+    return env
+
+@dataclass(slots=True)
+class RenderJob:
+    """A job as the resume template shows it, with all strings ready for LaTeX"""
+    position: str
+    organization: str
+    location: str
+    date_range: str
+    description: Optional[str]
+    items: List[str]
 
 class PyCv:
-    def __init__(self, joblink: str, projectname: str, datadir: str = 'data'):
+    def __init__(self, joblink: str, projectname: str, datadir: str = 'data', batch: bool = False, use_cache: bool = True):
         """Initialize the PyCv class with OpenAI credentials"""
         self.datastore = YamlStore(datadir)
         self.datastore.load_data()
         self.joblink = self._parse_joblink(joblink)
         self.projectname = projectname
-        self.ai = Ai()
+        self.resume_file = f"resume.{projectname}.tex"
+        self.coverletter_file = f"coverletter.{projectname}.tex"
+        self._template_dir = os.path.abspath('./templates')
+        self.batch = batch
         if self.projectname == "test":
             self.ai = StubAi()
+        else:
+            self.ai = Ai(use_cache)
         self.logger = logging.getLogger(self.__class__.__name__)
+        # Both documents are rendered in every run, so load their templates up front
+        env = _get_jinja_env(self._template_dir)
+        self._templates = {
+            "resume": env.get_template('resume.tex.jinja'),
+            "coverletter": env.get_template('coverletter.tex.jinja'),
+        }
 
     def _parse_joblink(self, joblink):
         if joblink.startswith("http"):
@@ -32,69 +82,134 @@ class PyCv:
                 jobad = file.read()
             return jobad
 
-    def _get_jinja_env(self):
-        return jinja2.Environment(
-            block_start_string = '\BLOCK{',
-            block_end_string = '}',
-            variable_start_string = r'\VAR{',
-            variable_end_string = '}',
-            comment_start_string = r'\#{',
-            comment_end_string = '}',
-            line_statement_prefix = '%%',
-            line_comment_prefix = '%#',
-            trim_blocks = True,
-            autoescape = False,
-            loader = jinja2.FileSystemLoader(os.path.abspath('./templates'))
-        )
-
-    def generate_coverletter(self):
+    def generate_coverletter(self, letterinfo):
         """Generate the complete LaTeX document"""
         self.logger.info("Started processing coverletter...") 
-        latex_jinja_env = self._get_jinja_env()
-        template = latex_jinja_env.get_template('coverletter.tex.jinja')
-        latex_coverletter = template.render(
-                headers = self.datastore.headers,
-                letterinfo = self.ai.get_letterinfo(
-                    self.datastore.statements,
-                    self.datastore.carstories,
-                    self.joblink),
-                name = self.datastore.headers['name'],
-                joblink = self.joblink,
-        )
-        filename = "coverletter."  + self.projectname + ".tex"
-        with open(filename, "w") as fout:
-            fout.write(latex_coverletter)
-
-    def generate_resume(self):
+        with open(self.coverletter_file, "w") as fout:
+            self._templates["coverletter"].stream(
+                    headers = self.datastore.headers,
+                    letterinfo = letterinfo,
+                    name = self.datastore.headers['name'],
+                    joblink = self.joblink,
+            ).dump(fout)
+
+    def generate_resume(self, summary, jobblocks):
         """Generate the complete LaTeX document"""
         self.logger.info("Started processing resume...") 
-        latex_jinja_env = self._get_jinja_env()
-        template = latex_jinja_env.get_template('resume.tex.jinja')
-        latex_resume = template.render(
-                headers = self.datastore.headers,
-                name = self.datastore.headers['name'],
-                summary = self.ai.get_summary(self.datastore.skills, self.datastore.carstories, self.datastore.statements, self.datastore.jobs, self.joblink),
-                jobblocks = self._get_job_blocks(),
-                education = self.datastore.education,
-                projects = self.datastore.projects,
-                skills = self.datastore.skills,
-                languages = self.datastore.languages,
-                joblink = self.joblink,
-        )
-        filename = "resume."  + self.projectname + ".tex"
-        with open(filename, "w") as fout:
-            fout.write(latex_resume)
-
-    def _get_job_blocks(self) -> list:
-        jobblocks = []
-        jobdescriptions = self.ai.get_job_summaries(self.datastore.jobs, self.datastore.carstories, self.datastore.statements, self.joblink)
-        jobitems = self.ai.get_experience(self.datastore.jobs, self.datastore.carstories, jobdescriptions, self.joblink)
+        # Stream the document into the file instead of building it in memory first
+        with open(self.resume_file, "w") as fout:
+            self._templates["resume"].stream(
+                    headers = self.datastore.headers,
+                    name = self.datastore.headers['name'],
+                    summary = summary,
+                    jobblocks = jobblocks,
+                    education = self.datastore.education,
+                    projects = self.datastore.projects,
+                    skills = self.datastore.skills,
+                    languages = self.datastore.languages,
+                    joblink = self.joblink,
+            ).dump(fout)
+
+    def _get_job_blocks(self, jobdescriptions, jobitems) -> list:
+        # Group the AI answers by job in one pass instead of filtering them for every job
+        jds_by_job = {}
+        for jd in jobdescriptions:
+            jds_by_job.setdefault(jd.job, []).append(jd)
+        jis_by_job = {}
+        for ji in jobitems:
+            jis_by_job.setdefault(ji.job, []).append(ji)
+        # The AI's answers are escaped here, so the template only has to paste them in
+        renderjobs = []
         for job in self.datastore.jobs:
-            jds = [jd for jd in jobdescriptions if jd.job == job.job]
-            jis = [ji for ji in jobitems if ji.job == job.job]
-            jobblocks += [[job, jds, jis]]
-        return jobblocks
-
-    def save_latex(self):
-        self.generate_resume()
-        self.generate_coverletter()
+            jds = jds_by_job.get(job.job)
+            renderjobs.append(RenderJob(
+                    position = job.position,
+                    organization = job.organization,
+                    location = job.location,
+                    date_range = f"{job.date[0]}\\textemdash {job.date[1]}",
+                    description = sanitize_text_for_latex(jds[0].description) if jds else None,
+                    items = [sanitize_text_for_latex(ji.item) for ji in jis_by_job.get(job.job, [])],
+            ))
+        return renderjobs
+
+    async def _ask_ai_batched(self):
+        """Send the independent AI requests as one batch"""
+        ds = self.datastore
+        res = await self.ai.ask_batch({
+                "summary": self.ai.summary_request(ds.skills, ds.carstories, ds.statements, ds.jobs, self.joblink),
+                "jobsummaries": self.ai.job_summaries_request(ds.jobs, ds.carstories, ds.statements, self.joblink),
+                "experience": self.ai.experience_request(ds.jobs, ds.carstories, self.joblink),
+                "letterinfo": self.ai.letterinfo_request(ds.statements, ds.carstories, self.joblink),
+        })
+        return res["summary"], res["jobsummaries"], res["experience"].items, res["letterinfo"]
+
+    async def _compile(self, filename: str) -> int:
+        """Run xelatex on a file, with a second pass only if LaTeX asks for it"""
+        for _ in range(2):
+            process = await asyncio.create_subprocess_exec(
+                    'xelatex', '-interaction=batchmode', '-halt-on-error', filename)
+            returncode = await process.wait()
+            logfile = os.path.splitext(filename)[0] + '.log'
+            if returncode != 0 or not os.path.exists(logfile):
+                break
+            with open(logfile, 'r', encoding='utf-8', errors='replace') as f:
+                if 'Rerun to get' not in f.read():
+                    break
+        if returncode != 0:
+            # batchmode keeps xelatex quiet, so show the errors from its log
+            self.logger.error("xelatex failed for %s (exit code %d), see %s for details%s",
+                    filename, returncode, logfile, self._latex_errors(logfile))
+        return returncode
+
+    def _latex_errors(self, logfile: str) -> str:
+        """Return the error messages and line numbers from a LaTeX log file"""
+        if not os.path.exists(logfile):
+            return ""
+        with open(logfile, 'r', encoding='utf-8', errors='replace') as f:
+            return "".join("\n" + line.rstrip() for line in f if _LATEX_ERROR_LINE.match(line))
+
+    async def _write_resume(self, summary, jobdescriptions, jobitems, compile: bool) -> int:
+        self.generate_resume(summary, self._get_job_blocks(jobdescriptions, jobitems))
+        return await self._compile(self.resume_file) if compile else 0
+
+    async def _write_coverletter(self, letterinfo, compile: bool) -> int:
+        self.generate_coverletter(letterinfo)
+        return await self._compile(self.coverletter_file) if compile else 0
+
+    async def _make_coverletter(self, compile: bool) -> int:
+        ds = self.datastore
+        letterinfo = await self.ai.get_letterinfo(ds.statements, ds.carstories, self.joblink)
+        return await self._write_coverletter(letterinfo, compile)
+
+    async def _generate(self, compile: bool) -> bool:
+        """Ask the AI and write the documents, compiling each as soon as it is written.
+        Returns False if xelatex failed for one of them."""
+        ds = self.datastore
+        if self.batch:
+            summary, jobdescriptions, jobitems, letterinfo = await self._ask_ai_batched()
+            returncodes = await asyncio.gather(
+                    self._write_resume(summary, jobdescriptions, jobitems, compile),
+                    self._write_coverletter(letterinfo, compile),
+            )
+            return not any(returncodes)
+        # The cover letter is written and compiled as soon as its own answer is in
+        coverletter = asyncio.create_task(self._make_coverletter(compile))
+        try:
+            summary, jobdescriptions, jobitems = await asyncio.gather(
+                    self.ai.get_summary(ds.skills, ds.carstories, ds.statements, ds.jobs, self.joblink),
+                    self.ai.get_job_summaries(ds.jobs, ds.carstories, ds.statements, self.joblink),
+                    self.ai.get_experience(ds.jobs, ds.carstories, self.joblink),
+            )
+            resume_returncode = await self._write_resume(summary, jobdescriptions, jobitems, compile)
+        except BaseException:
+            # Stop the cover letter too and collect its outcome, so only the real error is reported
+            coverletter.cancel()
+            await asyncio.gather(coverletter, return_exceptions=True)
+            raise
+        coverletter_returncode = await coverletter
+        return not (resume_returncode or coverletter_returncode)
+
+    def save_latex(self, compile: bool = False) -> bool:
+        """Write the resume and cover letter, and compile them if asked to.
+        Returns False if compiling one of them failed."""
+        return asyncio.run(self._generate(compile))
@@ -0,0 +1,19 @@
+_LATEX_ESCAPE = str.maketrans({
+    '\\': r'\textbackslash{}',
+    '^': r'\textasciicircum{}',
+    '~': r'\textasciitilde{}',
+    '_': r'\_',
+    '%': r'\%',
+    '&': r'\&',
+    '#': r'\#',
+    '$': r'\$',
+    '{': r'\{',
+    '}': r'\}',
+})
+
+def sanitize_text_for_latex(text: str) -> str:
+    """Escape characters with a special meaning in LaTeX, in a single pass.
+    Anything that is not a string is returned as is, so it also works as a Jinja filter."""
+    if not isinstance(text, str):
+        return text
+    return text.translate(_LATEX_ESCAPE)